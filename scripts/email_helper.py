@@ -1,26 +1,68 @@
 """IMAP and SMTP helper functions for email processing."""
 
 import imaplib
+import re
 import smtplib
 import email
+import tempfile
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.header import decode_header
-from typing import List, Dict, Optional, Tuple
+from typing import IO, List, Dict, Optional, Tuple
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum number of messages requested per IMAP FETCH command
+FETCH_BATCH_SIZE = 100
+
+# Attachment payloads up to this size stay in memory; larger ones roll over
+# to a temporary file, so a big backlog doesn't hold one fd per attachment
+ATTACHMENT_SPOOL_SIZE = 1024 * 1024
+
+# Matches the count in a STATUS response like b'INBOX (UNSEEN 3)'
+UNSEEN_COUNT_RE = re.compile(rb'UNSEEN (\d+)')
+
+# Matches the UID in a FETCH response like b'7 (UID 1042 BODY[] {2048}'
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+
 
 class Attachment:
-    """Represents an email attachment."""
+    """
+    Represents an email attachment.
+
+    Large payloads are spooled to a temporary file instead of being held
+    in memory for the lifetime of the message; they are read back on
+    access. Call close() once the attachment has been handled.
+    """
 
     def __init__(self):
         self.filename: str = ""
         self.content_type: str = ""
         self.size: int = 0
-        self.data: bytes = b""
+        self._file: Optional[IO[bytes]] = None
+
+    @property
+    def data(self) -> bytes:
+        """Attachment payload, read back from the temporary file."""
+        if self._file is None:
+            return b""
+        self._file.seek(0)
+        return self._file.read()
+
+    @data.setter
+    def data(self, value: bytes):
+        self.close()
+        self._file = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+        self._file.write(value)
+        self.size = len(value)
+
+    def close(self):
+        """Release the payload and any temporary file backing it."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
 class EmailMessage:
@@ -53,12 +95,35 @@ def connect_imap(host: str, port: int, user: str, password: str) -> imaplib.IMAP
     Returns:
         IMAP connection object
     """
-    logger.info(f"Connecting to IMAP server {host}:{port}")
+    logger.info("Connecting to IMAP server %s:%s", host, port)
     mail = imaplib.IMAP4_SSL(host, port)
     mail.login(user, password)
     return mail
 
 
+def count_unseen_emails(mail: imaplib.IMAP4_SSL, mailbox: str = "INBOX") -> Optional[int]:
+    """
+    Get the number of unseen emails without selecting the mailbox.
+
+    Args:
+        mail: IMAP connection object
+        mailbox: Mailbox name (default: INBOX)
+
+    Returns:
+        Unseen message count, or None if the server response can't be read
+    """
+    try:
+        status, data = mail.status(mailbox, '(UNSEEN)')
+        if status != 'OK' or not data or not data[0]:
+            return None
+
+        match = UNSEEN_COUNT_RE.search(data[0])
+        return int(match.group(1)) if match else None
+    except Exception as e:
+        logger.warning("Error checking unseen count for %s: %s", mailbox, e)
+        return None
+
+
 def fetch_unseen_emails(mail: imaplib.IMAP4_SSL, mailbox: str = "INBOX") -> List[EmailMessage]:
     """
     Fetch all unseen emails from mailbox.
@@ -70,27 +135,104 @@ def fetch_unseen_emails(mail: imaplib.IMAP4_SSL, mailbox: str = "INBOX") -> List
     Returns:
         List of EmailMessage objects
     """
-    logger.info(f"Fetching unseen emails from {mailbox}")
+    logger.info("Fetching unseen emails from %s", mailbox)
+
+    # STATUS is cheaper than SELECT; skip the mailbox entirely when nothing is new
+    if count_unseen_emails(mail, mailbox) == 0:
+        logger.info("Found 0 unseen emails")
+        return []
+
     mail.select(mailbox)
 
-    # Search for unseen messages
-    status, messages = mail.search(None, 'UNSEEN')
+    # Search by UID so the IDs stay valid however the mailbox changes meanwhile
+    status, messages = mail.uid('SEARCH', None, 'UNSEEN')
 
     if status != 'OK':
         logger.error("Failed to search for unseen messages")
         return []
 
     email_ids = messages[0].split()
-    logger.info(f"Found {len(email_ids)} unseen emails")
+    logger.info("Found %s unseen emails", len(email_ids))
+
+    emails = []
+    for start in range(0, len(email_ids), FETCH_BATCH_SIZE):
+        batch = email_ids[start:start + FETCH_BATCH_SIZE]
+        try:
+            emails.extend(fetch_emails_by_ids(mail, batch))
+        except Exception as e:
+            logger.error("Error fetching emails %s: %s", b','.join(batch).decode(), e)
+            continue
+
+    return emails
+
+
+def compact_message_set(email_ids: List[bytes]) -> bytes:
+    """
+    Build an IMAP message set, coalescing consecutive IDs into ranges.
+
+    Args:
+        email_ids: Numeric email UIDs
+
+    Returns:
+        Message set like b'1,3:7,10'
+    """
+    numbers = sorted({int(email_id) for email_id in email_ids})
+    ranges = []
+    start = prev = numbers[0]
+    for number in numbers[1:]:
+        if number != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = number
+        prev = number
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges).encode()
+
+
+def fetch_emails_by_ids(mail: imaplib.IMAP4_SSL, email_ids: List[bytes]) -> List[EmailMessage]:
+    """
+    Fetch and parse several emails with a single UID FETCH command.
+
+    Uses BODY.PEEK[] so fetching does not set the \\Seen flag; emails are
+    only marked as seen once they have been processed successfully.
+
+    Args:
+        mail: IMAP connection object
+        email_ids: Email UIDs to fetch
+
+    Returns:
+        List of EmailMessage objects
+    """
+    if not email_ids:
+        return []
+
+    status, msg_data = mail.uid('FETCH', compact_message_set(email_ids), '(BODY.PEEK[])')
+
+    if status != 'OK':
+        return []
 
     emails = []
-    for email_id in email_ids:
+    for i, item in enumerate(msg_data):
+        # Message literals come back as (b'<seq> (UID <uid> BODY[] {size}', raw_bytes),
+        # each followed by a closing bytes entry like b')'
+        if not isinstance(item, tuple):
+            continue
+
+        match = FETCH_UID_RE.search(item[0])
+        if not match:
+            # Servers may also send the UID after the literal: b' UID <uid>)'
+            trailer = msg_data[i + 1] if i + 1 < len(msg_data) else None
+            if isinstance(trailer, bytes):
+                match = FETCH_UID_RE.search(trailer)
+
+        if not match:
+            logger.error("Could not find UID in FETCH response %s; skipping message", item[0][:80])
+            continue
+
+        email_id = match.group(1)
         try:
-            msg = fetch_email_by_id(mail, email_id)
-            if msg:
-                emails.append(msg)
+            emails.append(parse_email(item[1], email_id))
         except Exception as e:
-            logger.error(f"Error fetching email {email_id}: {e}")
+            logger.error("Error parsing email %s: %s", email_id.decode(), e)
             continue
 
     return emails
@@ -98,21 +240,30 @@ def fetch_unseen_emails(mail: imaplib.IMAP4_SSL, mailbox: str = "INBOX") -> List
 
 def fetch_email_by_id(mail: imaplib.IMAP4_SSL, email_id: bytes) -> Optional[EmailMessage]:
     """
-    Fetch and parse a single email by ID.
+    Fetch and parse a single email by UID.
 
     Args:
         mail: IMAP connection object
-        email_id: Email ID to fetch
+        email_id: Email UID to fetch
 
     Returns:
         EmailMessage object or None
     """
-    status, msg_data = mail.fetch(email_id, '(RFC822)')
+    emails = fetch_emails_by_ids(mail, [email_id])
+    return emails[0] if emails else None
 
-    if status != 'OK':
-        return None
 
-    raw_email = msg_data[0][1]
+def parse_email(raw_email: bytes, email_id: bytes) -> EmailMessage:
+    """
+    Parse a raw RFC822 email.
+
+    Args:
+        raw_email: Raw email bytes
+        email_id: Email UID the message was fetched with
+
+    Returns:
+        EmailMessage object
+    """
     msg = email.message_from_bytes(raw_email)
 
     parsed = EmailMessage()
@@ -132,8 +283,7 @@ def fetch_email_by_id(mail: imaplib.IMAP4_SSL, email_id: bytes) -> Optional[Emai
         parsed.references = references.split()
 
     # Parse body and attachments
-    parsed.body, parsed.html_body = extract_email_body(msg)
-    parsed.attachments = extract_attachments(msg)
+    parsed.body, parsed.html_body, parsed.attachments = parse_email_parts(msg)
 
     return parsed
 
@@ -151,106 +301,110 @@ def decode_email_header(header: str) -> str:
     if not header:
         return ""
 
-    decoded_parts = decode_header(header)
-    decoded_str = ""
+    decoded_parts = []
 
-    for part, encoding in decoded_parts:
+    for part, encoding in decode_header(header):
         if isinstance(part, bytes):
-            decoded_str += part.decode(encoding or 'utf-8', errors='ignore')
+            decoded_parts.append(part.decode(encoding or 'utf-8', errors='ignore'))
         else:
-            decoded_str += part
+            decoded_parts.append(part)
 
-    return decoded_str
+    return "".join(decoded_parts)
 
 
-def extract_attachments(msg: email.message.Message) -> List[Attachment]:
+def decode_body_chunks(chunks: List[Tuple[bytes, str]]) -> str:
     """
-    Extract attachments from email.
+    Decode and concatenate raw body parts.
+
+    When all parts share a charset (the common case) they are joined as
+    bytes and decoded with a single call; otherwise each part is decoded
+    with its own charset.
 
     Args:
-        msg: Email message object
+        chunks: List of (payload bytes, charset) tuples
 
     Returns:
-        List of Attachment objects
+        Decoded text
     """
-    attachments = []
-
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_disposition = str(part.get("Content-Disposition", ""))
-
-            # Check if this is an attachment
-            if "attachment" in content_disposition or part.get_filename():
-                try:
-                    filename = part.get_filename()
-                    if not filename:
-                        continue
-
-                    # Decode filename if needed
-                    filename = decode_email_header(filename)
-
-                    # Get content type
-                    content_type = part.get_content_type()
-
-                    # Get attachment data
-                    data = part.get_payload(decode=True)
-                    if not data:
-                        continue
-
-                    # Create attachment object
-                    attachment = Attachment()
-                    attachment.filename = filename
-                    attachment.content_type = content_type
-                    attachment.size = len(data)
-                    attachment.data = data
+    charsets = {charset for _, charset in chunks}
 
-                    attachments.append(attachment)
-                    logger.info(f"Found attachment: {filename} ({content_type}, {len(data)} bytes)")
+    if len(charsets) == 1:
+        try:
+            return b"".join(data for data, _ in chunks).decode(charsets.pop(), errors='ignore')
+        except LookupError:
+            # Unknown charset - fall through so the failing parts get logged
+            pass
 
-                except Exception as e:
-                    logger.warning(f"Error extracting attachment: {e}")
-                    continue
+    decoded = []
+    for data, charset in chunks:
+        try:
+            decoded.append(data.decode(charset, errors='ignore'))
+        except LookupError as e:
+            logger.warning("Error extracting email part: %s", e)
 
-    return attachments
+    return "".join(decoded)
 
 
-def extract_email_body(msg: email.message.Message) -> Tuple[str, str]:
+def parse_email_parts(msg: email.message.Message) -> Tuple[str, str, List[Attachment]]:
     """
-    Extract plain text and HTML body from email.
+    Extract body text and attachments from email in a single MIME walk.
 
     Args:
         msg: Email message object
 
     Returns:
-        Tuple of (plain_text_body, html_body)
+        Tuple of (plain_text_body, html_body, attachments)
     """
     plain_body = ""
     html_body = ""
+    attachments = []
 
     if msg.is_multipart():
+        # Raw (payload, charset) chunks per body type, decoded once after the walk
+        plain_chunks = []
+        html_chunks = []
+
         for part in msg.walk():
             content_type = part.get_content_type()
             content_disposition = str(part.get("Content-Disposition", ""))
+            is_attachment = "attachment" in content_disposition
+            filename = part.get_filename()
+
+            # Only text parts that aren't attachments contribute to the body
+            is_body = not is_attachment and content_type in ("text/plain", "text/html")
 
-            # Skip attachments
-            if "attachment" in content_disposition:
+            if not (is_attachment or filename or is_body):
                 continue
 
             try:
-                body = part.get_payload(decode=True)
-                if body is None:
-                    continue
-
-                charset = part.get_content_charset() or 'utf-8'
-                body = body.decode(charset, errors='ignore')
-
-                if content_type == "text/plain":
-                    plain_body += body
-                elif content_type == "text/html":
-                    html_body += body
+                data = part.get_payload(decode=True)
             except Exception as e:
-                logger.warning(f"Error extracting email part: {e}")
+                logger.warning("Error decoding email part: %s", e)
+                continue
+
+            if not data:
                 continue
+
+            if is_body:
+                chunks = plain_chunks if content_type == "text/plain" else html_chunks
+                chunks.append((data, part.get_content_charset() or 'utf-8'))
+
+            if filename:
+                try:
+                    # Create attachment object
+                    attachment = Attachment()
+                    attachment.filename = decode_email_header(filename)
+                    attachment.content_type = content_type
+                    attachment.data = data
+
+                    attachments.append(attachment)
+                    logger.info("Found attachment: %s (%s, %s bytes)", attachment.filename, content_type, len(data))
+
+                except Exception as e:
+                    logger.warning("Error extracting attachment: %s", e)
+
+        plain_body = decode_body_chunks(plain_chunks)
+        html_body = decode_body_chunks(html_chunks)
     else:
         content_type = msg.get_content_type()
         try:
@@ -264,37 +418,178 @@ def extract_email_body(msg: email.message.Message) -> Tuple[str, str]:
                 else:
                     plain_body = body
         except Exception as e:
-            logger.warning(f"Error extracting email body: {e}")
+            logger.warning("Error extracting email body: %s", e)
 
-    return plain_body.strip(), html_body.strip()
+    return plain_body.strip(), html_body.strip(), attachments
 
 
-def mark_email_as_seen(mail: imaplib.IMAP4_SSL, email_id: bytes) -> bool:
+def mark_emails_as_seen(mail: imaplib.IMAP4_SSL, email_ids: List[bytes]) -> bool:
     """
-    Mark email as seen/read.
+    Mark emails as seen/read with a single UID STORE command.
 
     Args:
         mail: IMAP connection object
-        email_id: Email ID to mark
+        email_ids: Email UIDs to mark
 
     Returns:
         True if successful
     """
+    if not email_ids:
+        return True
+
+    message_set = compact_message_set(email_ids)
+
     try:
-        mail.store(email_id, '+FLAGS', '\\Seen')
-        logger.info(f"Marked email {email_id.decode()} as seen")
+        status, _ = mail.uid('STORE', message_set, '+FLAGS', '\\Seen')
+        if status != 'OK':
+            logger.error("Error marking emails %s as seen: %s", message_set.decode(), status)
+            return False
+
+        logger.info("Marked %s email(s) as seen: %s", len(email_ids), message_set.decode())
         return True
     except Exception as e:
-        logger.error(f"Error marking email as seen: {e}")
+        logger.error("Error marking emails as seen: %s", e)
         return False
 
 
+class SMTPSender:
+    """
+    Reusable SMTP session for sending one or more emails.
+
+    Connects, runs STARTTLS and authenticates once on the first send, so a
+    batch of emails pays for a single handshake and a run that sends nothing
+    pays for none:
+
+        with SMTPSender(host, port, user, password) as sender:
+            for msg in messages:
+                sender.send(msg)
+
+    If the server drops an idle session, the next send reconnects once.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str):
+        """
+        Initialize SMTP sender.
+
+        Args:
+            host: SMTP server hostname
+            port: SMTP server port
+            user: SMTP username
+            password: SMTP password
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.server: Optional[smtplib.SMTP] = None
+
+    def __enter__(self) -> "SMTPSender":
+        return self
+
+    def connect(self):
+        """Open the SMTP session: connect, STARTTLS and log in."""
+        logger.info("Connecting to SMTP server %s:%s", self.host, self.port)
+        self.server = smtplib.SMTP(self.host, self.port)
+        try:
+            self.server.starttls()
+            self.server.login(self.user, self.password)
+        except Exception:
+            self.server.close()
+            self.server = None
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception as e:
+            logger.warning("Error closing SMTP connection: %s", e)
+        finally:
+            self.server = None
+
+    def send(self, msg: MIMEMultipart) -> bool:
+        """
+        Send a message, opening the session if it is not open yet.
+
+        Args:
+            msg: Message built with build_email
+
+        Returns:
+            True if successful
+        """
+        to_addr = msg['To']
+        logger.info("Sending email to %s", to_addr)
+
+        try:
+            if self.server is None:
+                self.connect()
+            try:
+                self.server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Servers close idle sessions; a NOOP before every send would
+                # cost a round-trip, so reconnect only when that happened
+                logger.info("SMTP session was closed by the server, reconnecting")
+                self.connect()
+                self.server.send_message(msg)
+            logger.info("Email sent successfully to %s", to_addr)
+            return True
+        except Exception as e:
+            logger.error("Error sending email: %s", e)
+            return False
+
+
+def build_email(from_addr: str, to_addr: str, subject: str, body: str,
+                in_reply_to: str = "", references: List[str] = None,
+                message_id: str = "") -> MIMEMultipart:
+    """
+    Build an email message with threading headers.
+
+    Args:
+        from_addr: Sender email address
+        to_addr: Recipient email address
+        subject: Email subject
+        body: Email body (plain text)
+        in_reply_to: In-Reply-To header for threading
+        references: List of References for threading
+        message_id: Message-ID to use
+
+    Returns:
+        Message ready to send
+    """
+    msg = MIMEMultipart('alternative')
+    msg['From'] = from_addr
+    msg['To'] = to_addr
+    msg['Subject'] = subject
+
+    if message_id:
+        msg['Message-ID'] = message_id
+
+    if in_reply_to:
+        msg['In-Reply-To'] = in_reply_to
+
+    if references:
+        msg['References'] = ' '.join(references)
+
+    # Add plain text part
+    msg.attach(MIMEText(body, 'plain'))
+
+    # TODO: Add HTML part if needed
+    # html_body = markdown_to_html(body)
+    # msg.attach(MIMEText(html_body, 'html'))
+
+    return msg
+
+
 def send_email(smtp_host: str, smtp_port: int, smtp_user: str, smtp_password: str,
                from_addr: str, to_addr: str, subject: str, body: str,
                in_reply_to: str = "", references: List[str] = None,
                message_id: str = "") -> bool:
     """
-    Send email via SMTP.
+    Send a single email via SMTP.
+
+    Opens a dedicated connection; use SMTPSender directly to send
+    several emails over one session.
 
     Args:
         smtp_host: SMTP server hostname
@@ -312,50 +607,26 @@ def send_email(smtp_host: str, smtp_port: int, smtp_user: str, smtp_password: st
     Returns:
         True if successful
     """
-    logger.info(f"Sending email to {to_addr}")
-
     try:
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['From'] = from_addr
-        msg['To'] = to_addr
-        msg['Subject'] = subject
-
-        if message_id:
-            msg['Message-ID'] = message_id
-
-        if in_reply_to:
-            msg['In-Reply-To'] = in_reply_to
+        msg = build_email(from_addr, to_addr, subject, body,
+                          in_reply_to=in_reply_to, references=references,
+                          message_id=message_id)
 
-        if references:
-            msg['References'] = ' '.join(references)
-
-        # Add plain text part
-        msg.attach(MIMEText(body, 'plain'))
-
-        # TODO: Add HTML part if needed
-        # html_body = markdown_to_html(body)
-        # msg.attach(MIMEText(html_body, 'html'))
-
-        # Connect and send
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
-
-        logger.info(f"Email sent successfully to {to_addr}")
-        return True
+        with SMTPSender(smtp_host, smtp_port, smtp_user, smtp_password) as sender:
+            return sender.send(msg)
 
     except Exception as e:
-        logger.error(f"Error sending email: {e}")
+        logger.error("Error sending email: %s", e)
         return False
 
 
 def close_imap(mail: imaplib.IMAP4_SSL):
     """Close IMAP connection."""
     try:
-        mail.close()
+        # CLOSE is only valid once a mailbox has been selected
+        if mail.state == 'SELECTED':
+            mail.close()
         mail.logout()
         logger.info("IMAP connection closed")
     except Exception as e:
-        logger.warning(f"Error closing IMAP connection: {e}")
+        logger.warning("Error closing IMAP connection: %s", e)
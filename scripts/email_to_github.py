@@ -9,21 +9,33 @@ Runs on a schedule via GitHub Actions.
 import os
 import sys
 import logging
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
 
 from email_helper import (
-    connect_imap, fetch_unseen_emails, mark_email_as_seen, close_imap
+    connect_imap, fetch_unseen_emails, mark_emails_as_seen, close_imap
 )
 from github_helper import GitHubHelper
 from utils import (
     extract_gh_number_from_subject, format_issue_title, sanitize_email_body,
     format_metadata_comment, parse_email_address, create_email_marker,
-    parse_metadata_from_issue_body
+    parse_metadata_from_issue_body, TICKET_PREFIX
 )
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of email threads processed concurrently
+MAX_WORKERS = 8
+
+# Attachment content types embedded inline as images
+IMAGE_TYPES = frozenset({'image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/bmp', 'image/webp'})
+
+# New issues are created one at a time: attachments are uploaded under the
+# predicted issue number, which concurrent creations would invalidate
+ISSUE_CREATION_LOCK = threading.Lock()
+
 
 def get_env_or_exit(var_name: str) -> str:
     """Get environment variable or exit if not set."""
@@ -52,31 +64,123 @@ def process_email(email_msg, github: GitHubHelper, project_id: str = None) -> bo
     from_email = parse_email_address(email_msg.from_addr)
     logger.info(f"Sender email: {from_email}")
 
-    # Get ticket prefix from environment
-    ticket_prefix = os.getenv('TICKET_PREFIX', 'GH')
+    # An email whose own Message-ID is already in an issue's metadata was
+    # handled by an earlier run that failed before marking it as seen
+    if email_msg.message_id:
+        _, handled_issue = github.find_issue_by_message_ids([email_msg.message_id])
+        if handled_issue:
+            logger.info(f"[SKIP] Email {email_msg.message_id} already recorded on issue #{handled_issue['number']}")
+            return True
 
     # Check if this is a reply to an existing ticket
     gh_number = extract_gh_number_from_subject(email_msg.subject)
 
     if gh_number:
         # Reply to existing issue
-        logger.info(f"[REPLY] Found {ticket_prefix}-{gh_number} in subject, adding comment to existing issue")
-        return handle_reply(email_msg, gh_number, from_email, github)
+        logger.info(f"[REPLY] Found {TICKET_PREFIX}-{gh_number} in subject, adding comment to existing issue")
+        return handle_reply(email_msg, gh_number, None, from_email, github)
+    elif not email_msg.in_reply_to and not email_msg.references:
+        # First-contact email: no threading headers, so no thread can match
+        logger.info(f"[NEW] No {TICKET_PREFIX} number or threading headers, creating new ticket for {from_email}")
+        with ISSUE_CREATION_LOCK:
+            return create_new_issue(email_msg, from_email, github, project_id)
     else:
         # Try to find existing issue by email metadata
-        logger.info(f"[NEW/REPLY] No {ticket_prefix} number in subject, searching by thread metadata...")
+        logger.info(f"[NEW/REPLY] No {TICKET_PREFIX} number in subject, searching by thread metadata...")
         existing_issue = find_issue_by_thread(email_msg, github)
 
         if existing_issue:
             logger.info(f"[REPLY] Found existing issue #{existing_issue['number']} by thread ID, adding comment")
-            return handle_reply(email_msg, existing_issue['number'], from_email, github)
+            return handle_reply(email_msg, existing_issue['number'], existing_issue, from_email, github)
         else:
             # Create new issue
             logger.info(f"[NEW] No existing issue found, creating new ticket for {from_email}")
-            return create_new_issue(email_msg, from_email, github, project_id)
+            with ISSUE_CREATION_LOCK:
+                return create_new_issue(email_msg, from_email, github, project_id)
+
 
+def group_related_emails(emails: List, github: GitHubHelper) -> List[List]:
+    """
+    Group emails that may touch the same issue.
+
+    Emails are related when they target the same existing issue (by subject
+    number or thread metadata) or share any Message-ID through their
+    threading headers. Each group keeps the original email order so it can
+    be processed sequentially, while separate groups run in parallel.
+
+    Args:
+        emails: List of EmailMessage objects
+        github: GitHubHelper instance
 
-def process_attachments(attachments, github: GitHubHelper, issue_number: int = None) -> str:
+    Returns:
+        List of email groups
+    """
+    # Union-find over threading keys; each email is linked to all of its keys
+    parent: Dict[str, str] = {}
+
+    def find(key: str) -> str:
+        parent.setdefault(key, key)
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    email_keys = []
+    for email_msg in emails:
+        message_ids = [email_msg.message_id, email_msg.in_reply_to, *email_msg.references]
+        keys = [f"msg:{message_id}" for message_id in message_ids if message_id]
+
+        issue_number = extract_gh_number_from_subject(email_msg.subject)
+        if not issue_number:
+            _, issue = github.find_issue_by_message_ids(message_ids[1:])
+            if issue:
+                issue_number = issue['number']
+        if issue_number:
+            keys.append(f"issue:{issue_number}")
+
+        # Emails without any threading keys stand alone
+        keys = keys or [f"uid:{email_msg.uid}"]
+        for key in keys[1:]:
+            parent[find(key)] = find(keys[0])
+        email_keys.append(keys[0])
+
+    groups: Dict[str, List] = {}
+    for email_msg, key in zip(emails, email_keys):
+        groups.setdefault(find(key), []).append(email_msg)
+
+    return list(groups.values())
+
+
+def process_email_group(group: List, github: GitHubHelper, project_id: str = None) -> List[Tuple[object, bool]]:
+    """
+    Process a group of related emails in order.
+
+    Args:
+        group: List of EmailMessage objects
+        github: GitHubHelper instance
+        project_id: Optional GitHub Project ID to add new issues to
+
+    Returns:
+        List of (email_msg, success) tuples
+    """
+    results = []
+    for email_msg in group:
+        try:
+            success = process_email(email_msg, github, project_id)
+            if not success:
+                logger.warning(f"Skipping email {email_msg.uid} due to processing error")
+        except Exception as e:
+            logger.error(f"Error processing email {email_msg.uid}: {e}")
+            success = False
+        finally:
+            # Attachments are uploaded by now; free their spooled payloads
+            for attachment in email_msg.attachments:
+                attachment.close()
+        results.append((email_msg, success))
+    return results
+
+
+def process_attachments(attachments, github: GitHubHelper, issue_number: int = None) -> List[str]:
     """
     Process email attachments: upload images and list non-images.
 
@@ -86,45 +190,84 @@ def process_attachments(attachments, github: GitHubHelper, issue_number: int = N
         issue_number: Issue number (for logging)
 
     Returns:
-        Markdown string with embedded images and attachment list
+        List of Markdown sections with embedded images and attachment list
     """
     if not attachments:
-        return ""
+        return []
+
+    # Files stored under the same name would overwrite each other in the
+    # repository, so different content with a repeated name gets a -<n> suffix
+    files = {}
+    stored_names = {}
+    for att in attachments:
+        name, data = att.filename, att.data
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while name in files and files[name] != data:
+            n += 1
+            name = f"{stem}-{n}{ext}"
+        files[name] = data
+        stored_names[att] = name
+
+    # Commit all attachments at once, falling back to per-file uploads
+    urls = dict(zip(attachments, github.upload_attachments(
+        [(stored_names[att], files[stored_names[att]]) for att in attachments], issue_number
+    )))
+    failed = [att for att in attachments if not urls[att]]
+    for att in failed:
+        urls[att] = github.upload_attachment_to_repo(files[stored_names[att]], stored_names[att], issue_number)
 
     # Separate images from other files
-    image_types = ['image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/bmp', 'image/webp']
-    images = [att for att in attachments if att.content_type in image_types]
-    other_files = [att for att in attachments if att.content_type not in image_types]
+    images, other_files = [], []
+    for att in attachments:
+        (images if att.content_type in IMAGE_TYPES else other_files).append(att)
 
     sections = []
 
-    # Upload and embed images
+    # Embed images
     if images:
         sections.append("### 📷 Attached Images\n")
         for img in images:
-            file_url = github.upload_attachment_to_repo(img.data, img.filename, issue_number)
-            if file_url:
-                sections.append(f"![{img.filename}]({file_url})\n")
+            if urls[img]:
+                sections.append(f"![{img.filename}]({urls[img]})\n")
                 logger.info(f"✅ Embedded image: {img.filename}")
             else:
                 # Fallback: add to other_files list if upload failed
                 logger.warning(f"Failed to upload image: {img.filename}, adding to file list")
                 other_files.append(img)
 
-    # Upload and link non-image attachments
+    # Link non-image attachments
     if other_files:
         sections.append("### 📎 Other Attachments\n")
         for file in other_files:
             size_kb = file.size / 1024
-            file_url = github.upload_attachment_to_repo(file.data, file.filename, issue_number)
-            if file_url:
-                sections.append(f"- [{file.filename}]({file_url}) ({size_kb:.1f} KB)\n")
+            if urls[file]:
+                sections.append(f"- [{file.filename}]({urls[file]}) ({size_kb:.1f} KB)\n")
                 logger.info(f"✅ Uploaded attachment: {file.filename}")
             else:
                 sections.append(f"- `{file.filename}` ({size_kb:.1f} KB) - ⚠️ Upload failed, check original email\n")
                 logger.warning(f"Failed to upload attachment: {file.filename}")
 
-    return "\n".join(sections)
+    return sections
+
+
+def build_body(clean_body: str, attachment_sections: List[str], footer: str) -> str:
+    """
+    Assemble an issue or comment body in a single join.
+
+    Args:
+        clean_body: Sanitized email text
+        attachment_sections: Markdown sections from process_attachments
+        footer: Trailing hidden marker or metadata comment
+
+    Returns:
+        Body text with blocks separated by blank lines
+    """
+    blocks = [clean_body]
+    if attachment_sections:
+        blocks.append("\n".join(attachment_sections))
+    blocks.append(footer)
+    return "\n\n".join(blocks)
 
 
 def create_new_issue(email_msg, from_email: str, github: GitHubHelper, project_id: str = None) -> bool:
@@ -140,9 +283,6 @@ def create_new_issue(email_msg, from_email: str, github: GitHubHelper, project_i
     Returns:
         True if successful
     """
-    # Get ticket prefix from environment
-    ticket_prefix = os.getenv('TICKET_PREFIX', 'GH')
-
     # Get next issue number (prediction)
     issue_number = github.get_next_issue_number()
 
@@ -154,7 +294,7 @@ def create_new_issue(email_msg, from_email: str, github: GitHubHelper, project_i
     clean_body = sanitize_email_body(body_text)
 
     # Process attachments
-    attachments_section = process_attachments(email_msg.attachments, github, issue_number)
+    attachment_sections = process_attachments(email_msg.attachments, github, issue_number)
 
     # Create metadata comment
     metadata = format_metadata_comment(
@@ -164,7 +304,7 @@ def create_new_issue(email_msg, from_email: str, github: GitHubHelper, project_i
     )
 
     # Combine body with attachments and metadata
-    full_body = f"{clean_body}\n\n{attachments_section}\n\n{metadata}" if attachments_section else f"{clean_body}\n\n{metadata}"
+    full_body = build_body(clean_body, attachment_sections, metadata)
 
     # Create labels
     labels = ["helpdesk", f"from:{from_email}"]
@@ -176,12 +316,13 @@ def create_new_issue(email_msg, from_email: str, github: GitHubHelper, project_i
         actual_number = issue['number']
         issue_node_id = issue.get('node_id')
         logger.info(f"✅ Successfully created issue #{actual_number}: {title}")
+        github.index_message_id(email_msg.message_id, issue)
 
         # If predicted number was wrong, update the title
         if actual_number != issue_number:
             correct_title = format_issue_title(actual_number, email_msg.subject)
             github.update_issue(actual_number, title=correct_title)
-            logger.info(f"Updated title to use correct issue number: [{ticket_prefix}-{actual_number:04d}]")
+            logger.info(f"Updated title to use correct issue number: [{TICKET_PREFIX}-{actual_number:04d}]")
 
         # Add to project if project_id is provided
         if project_id and issue_node_id:
@@ -196,21 +337,24 @@ def create_new_issue(email_msg, from_email: str, github: GitHubHelper, project_i
         return False
 
 
-def handle_reply(email_msg, issue_number: int, from_email: str, github: GitHubHelper) -> bool:
+def handle_reply(email_msg, issue_number: int, issue: Optional[dict], from_email: str,
+                 github: GitHubHelper) -> bool:
     """
     Add email as comment to existing issue.
 
     Args:
         email_msg: EmailMessage object
         issue_number: GitHub issue number
+        issue: Issue dict already found by thread lookup, or None to fetch it
         from_email: Sender email address
         github: GitHubHelper instance
 
     Returns:
         True if successful
     """
-    # Get issue to check if it's closed
-    issue = github.get_issue(issue_number)
+    # Get issue to check if it's closed, unless the thread lookup returned it
+    if issue is None:
+        issue = github.get_issue(issue_number)
 
     if not issue:
         logger.error(f"Issue #{issue_number} not found")
@@ -219,18 +363,19 @@ def handle_reply(email_msg, issue_number: int, from_email: str, github: GitHubHe
     # Reopen if closed
     if issue['state'] == 'closed':
         logger.info(f"🔓 Reopening closed issue #{issue_number} due to customer reply")
-        github.reopen_issue(issue_number)
+        if github.reopen_issue(issue_number):
+            issue['state'] = 'open'
 
     # Sanitize body
     body_text = email_msg.body if email_msg.body else email_msg.html_body
     clean_body = sanitize_email_body(body_text)
 
     # Process attachments
-    attachments_section = process_attachments(email_msg.attachments, github, issue_number)
+    attachment_sections = process_attachments(email_msg.attachments, github, issue_number)
 
     # Add email marker
     email_marker = create_email_marker()
-    comment_body = f"{clean_body}\n\n{attachments_section}\n\n{email_marker}" if attachments_section else f"{clean_body}\n\n{email_marker}"
+    comment_body = build_body(clean_body, attachment_sections, email_marker)
 
     # Add comment
     comment = github.add_comment(issue_number, comment_body)
@@ -240,6 +385,7 @@ def handle_reply(email_msg, issue_number: int, from_email: str, github: GitHubHe
 
         # Update issue metadata with new message ID
         update_issue_metadata(issue, email_msg.message_id, github)
+        github.index_message_id(email_msg.message_id, issue)
 
         return True
     else:
@@ -251,7 +397,8 @@ def find_issue_by_thread(email_msg, github: GitHubHelper) -> Optional[dict]:
     """
     Find existing issue by checking thread metadata.
 
-    Searches ALL open helpdesk issues and matches by email Message-ID threading headers.
+    Matches the email's Message-ID threading headers against the metadata of
+    ALL open helpdesk issues, using the thread index built once per run.
     This is more reliable than matching by customer email label alone.
 
     Args:
@@ -261,35 +408,13 @@ def find_issue_by_thread(email_msg, github: GitHubHelper) -> Optional[dict]:
     Returns:
         Issue dict or None
     """
-    # Search for ALL open helpdesk issues
-    query = "label:helpdesk is:open"
-    issues = github.search_issues(query)
-
-    if not issues:
-        logger.debug("No open helpdesk issues found")
-        return None
-
-    logger.info(f"Searching {len(issues)} open helpdesk issue(s) for matching email thread...")
-
-    # Check each issue to find the one with matching message IDs
-    for issue in issues:
-        # Parse metadata from this issue
-        metadata = parse_metadata_from_issue_body(issue['body'])
+    # Check if email references any message IDs stored in an issue's metadata
+    matched_id, issue = github.find_issue_by_message_ids([email_msg.in_reply_to, *email_msg.references])
 
-        if not metadata:
-            continue
-
-        stored_message_ids = metadata.get('message_ids', [])
-
-        # Check if email references any message IDs in this issue's metadata
-        if email_msg.in_reply_to and email_msg.in_reply_to in stored_message_ids:
-            logger.info(f"✓ Matched issue #{issue['number']} by In-Reply-To: {email_msg.in_reply_to}")
-            return issue
-
-        for ref in email_msg.references:
-            if ref in stored_message_ids:
-                logger.info(f"✓ Matched issue #{issue['number']} by References: {ref}")
-                return issue
+    if issue:
+        header = "In-Reply-To" if matched_id == email_msg.in_reply_to else "References"
+        logger.info(f"✓ Matched issue #{issue['number']} by {header}: {matched_id}")
+        return issue
 
     # No threading match found
     logger.debug(f"Email threading headers don't match any open issues")
@@ -318,24 +443,22 @@ def update_issue_metadata(issue: dict, new_message_id: str, github: GitHubHelper
         if new_message_id not in metadata['message_ids']:
             metadata['message_ids'].append(new_message_id)
 
-            # Replace old metadata comment with updated one
-            old_metadata_comment = format_metadata_comment(
-                metadata['thread_id'],
-                metadata['from'],
-                metadata['message_ids'][:-1]  # Old list
-            )
+            # Replace old metadata comment with updated one at its parsed position
             new_metadata_comment = format_metadata_comment(
                 metadata['thread_id'],
                 metadata['from'],
-                metadata['message_ids']  # Updated list
+                metadata['message_ids']
             )
 
-            new_body = issue['body'].replace(old_metadata_comment, new_metadata_comment)
-            github.update_issue(issue['number'], body=new_body)
-            logger.info(f"Updated metadata for issue #{issue['number']}")
+            start, end = metadata['span']
+            new_body = issue['body'][:start] + new_metadata_comment + issue['body'][end:]
+            if github.update_issue(issue['number'], body=new_body):
+                # Keep the shared dict current for later replies in this run
+                issue['body'] = new_body
+            logger.info("Updated metadata for issue #%s", issue['number'])
 
     except Exception as e:
-        logger.error(f"Error updating issue metadata: {e}")
+        logger.error("Error updating issue metadata: %s", e)
 
 
 def main():
@@ -365,8 +488,12 @@ def main():
         mail = connect_imap(imap_host, imap_port, imap_user, imap_password)
     except Exception as e:
         logger.error(f"Failed to connect to IMAP: {e}")
+        github.close()
         sys.exit(1)
 
+    # IDs of successfully processed emails, marked as seen in one batch
+    processed_ids = []
+
     try:
         # Fetch unseen emails
         emails = fetch_unseen_emails(mail)
@@ -376,23 +503,24 @@ def main():
         processed_count = 0
         failed_count = 0
 
-        # Process each email
-        for email_msg in emails:
-            try:
-                success = process_email(email_msg, github, github_project_id)
-
-                if success:
-                    # Mark as seen only if processing was successful
-                    mark_email_as_seen(mail, email_msg.uid.encode())
-                    processed_count += 1
-                else:
-                    logger.warning(f"Skipping email {email_msg.uid} due to processing error")
-                    failed_count += 1
-
-            except Exception as e:
-                logger.error(f"Error processing email {email_msg.uid}: {e}")
-                failed_count += 1
-                continue
+        # Process unrelated email threads concurrently; each thread stays in order.
+        # IMAP is only touched from this thread - the client is not thread-safe.
+        groups = group_related_emails(emails, github) if emails else []
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [
+                executor.submit(process_email_group, group, github, github_project_id)
+                for group in groups
+            ]
+
+            for future in as_completed(futures):
+                for email_msg, success in future.result():
+                    if success:
+                        # Mark as seen only if processing was successful
+                        processed_ids.append(email_msg.uid.encode())
+                        processed_count += 1
+                    else:
+                        failed_count += 1
 
         logger.info("=" * 60)
         logger.info(f"📊 Email processing summary:")
@@ -410,7 +538,10 @@ def main():
         logger.info("✅ All emails processed successfully!")
 
     finally:
+        # Flag everything processed so far, even if the run is aborting
+        mark_emails_as_seen(mail, processed_ids)
         close_imap(mail)
+        github.close()
 
 
 if __name__ == "__main__":
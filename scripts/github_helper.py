@@ -1,13 +1,50 @@
 """GitHub API helper functions."""
 
+import base64
+import hashlib
+import threading
+from urllib.parse import quote
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-from typing import Optional, Dict, List
+from typing import Optional, Dict, Iterable, List, Iterator, Tuple
+
+from utils import parse_metadata_from_issue_body
+
+try:
+    import orjson
+except ImportError:  # optional speedup; fall back to requests' stdlib decoder
+    orjson = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def parse_json(response: requests.Response):
+    """
+    Decode a JSON response body, using orjson when it is installed.
+
+    orjson parses the raw bytes directly, skipping the text decode that
+    response.json() does first. Decode errors are raised as requests'
+    JSONDecodeError either way, so RequestException handlers still apply.
+
+    Args:
+        response: HTTP response with a JSON body
+
+    Returns:
+        Decoded JSON value
+    """
+    if orjson is None:
+        return response.json()
+
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
+
+
 class GitHubHelper:
     """Wrapper for GitHub API operations."""
 
@@ -27,6 +64,55 @@ class GitHubHelper:
             "Accept": "application/vnd.github.v3+json"
         }
 
+        # Share one keep-alive session so API calls reuse TLS connections.
+        # Transient gateway errors are retried, but not for POST: a retried
+        # create could duplicate an issue or comment.
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET", "PUT", "PATCH"],
+            raise_on_status=False
+        )
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        # Next issue number, known after the first lookup or create_issue call
+        self._next_number: Optional[int] = None
+        # Contents API writes commit to the branch head; concurrent writes
+        # conflict, so each upload's existence check and write run as one step
+        self._contents_write_lock = threading.Lock()
+        # Email Message-ID -> open helpdesk issue, built on first thread lookup
+        self._thread_index: Optional[Dict[str, Dict]] = None
+        # Issue number -> the one indexed dict shared by all of its Message-IDs
+        self._indexed_issues: Dict[int, Dict] = {}
+        self._thread_index_lock = threading.RLock()
+        # (issue number, SHA-256 of content) -> URL of the uploaded attachment
+        self._attachment_cache: Dict[Tuple[int, bytes], str] = {}
+        # Repository path -> cache key of the content last written there
+        self._attachment_paths: Dict[str, Tuple[int, bytes]] = {}
+        # Default branch name and head commit OID, tracked across attachment commits
+        self._branch_head: Optional[Tuple[str, str]] = None
+
+    def close(self):
+        """Close the underlying HTTP session and its pooled connections."""
+        self.session.close()
+
+    def get_authenticated_user(self) -> str:
+        """
+        Get the username of the authenticated GitHub user.
+
+        Returns:
+            Username of the authenticated user, or empty string if failed
+        """
+        try:
+            response = self.session.get(f"{self.base_url}/user", timeout=10)
+            response.raise_for_status()
+            return parse_json(response).get('login', '')
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not get authenticated user: {e}")
+            return ''
+
     def create_issue(self, title: str, body: str, labels: List[str] = None) -> Optional[Dict]:
         """
         Create a new GitHub issue.
@@ -51,10 +137,12 @@ class GitHubHelper:
 
         try:
             logger.info(f"Creating issue: {title}")
-            response = requests.post(url, json=data, headers=self.headers)
+            response = self.session.post(url, json=data)
             response.raise_for_status()
-            issue = response.json()
+            issue = parse_json(response)
             logger.info(f"Created issue #{issue['number']}")
+            # Numbers are assigned sequentially, so the next one is known without a lookup
+            self._next_number = issue['number'] + 1
             return issue
         except requests.exceptions.RequestException as e:
             logger.error(f"Error creating issue: {e}")
@@ -77,9 +165,9 @@ class GitHubHelper:
 
         try:
             logger.info(f"Adding comment to issue #{issue_number}")
-            response = requests.post(url, json=data, headers=self.headers)
+            response = self.session.post(url, json=data)
             response.raise_for_status()
-            comment = response.json()
+            comment = parse_json(response)
             logger.info(f"Added comment to issue #{issue_number}")
             return comment
         except requests.exceptions.RequestException as e:
@@ -99,9 +187,9 @@ class GitHubHelper:
         url = f"{self.base_url}/repos/{self.repository}/issues/{issue_number}"
 
         try:
-            response = requests.get(url, headers=self.headers)
+            response = self.session.get(url)
             response.raise_for_status()
-            return response.json()
+            return parse_json(response)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error getting issue #{issue_number}: {e}")
             return None
@@ -135,9 +223,9 @@ class GitHubHelper:
 
         try:
             logger.info(f"Updating issue #{issue_number}")
-            response = requests.patch(url, json=data, headers=self.headers)
+            response = self.session.patch(url, json=data)
             response.raise_for_status()
-            return response.json()
+            return parse_json(response)
         except requests.exceptions.RequestException as e:
             logger.error(f"Error updating issue: {e}")
             return None
@@ -161,15 +249,54 @@ class GitHubHelper:
 
         try:
             logger.info(f"Searching issues: {query}")
-            response = requests.get(url, params=params, headers=self.headers)
+            response = self.session.get(url, params=params)
             response.raise_for_status()
-            results = response.json()
+            results = parse_json(response)
             logger.info(f"Found {results['total_count']} issues")
             return results.get('items', [])
         except requests.exceptions.RequestException as e:
             logger.error(f"Error searching issues: {e}")
             return []
 
+    def iter_search_issues(self, query: str, per_page: int = 100) -> Iterator[Dict]:
+        """
+        Search for issues, yielding results page by page.
+
+        Unlike search_issues, this follows pagination so that all matches
+        are returned, without holding every page in memory at once.
+
+        Args:
+            query: Search query (GitHub search syntax)
+            per_page: Number of results per page (max 100)
+
+        Yields:
+            Issue data dicts
+        """
+        url = f"{self.base_url}/search/issues"
+
+        # Add repository filter to query
+        full_query = f"{query} repo:{self.repository}"
+
+        logger.info(f"Searching issues: {query}")
+        page = 1
+        while True:
+            params = {"q": full_query, "per_page": per_page, "page": page}
+
+            try:
+                response = self.session.get(url, params=params)
+                response.raise_for_status()
+                results = parse_json(response)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Error searching issues (page {page}): {e}")
+                return
+
+            items = results.get('items', [])
+            yield from items
+
+            if len(items) < per_page or 'next' not in response.links:
+                return
+            page += 1
+
     def find_issue_by_email(self, email: str) -> Optional[Dict]:
         """
         Find issue by customer email address.
@@ -189,6 +316,195 @@ class GitHubHelper:
 
         return None
 
+    def iter_open_helpdesk_issues(self) -> Iterator[Dict]:
+        """
+        List all open helpdesk issues via the GraphQL API.
+
+        Uses cursor pagination, so every open issue is returned, and draws
+        on the GraphQL point budget instead of the scarcer Search API limit.
+
+        The first page also asks for the newest issue and pull request
+        number, seeding the next-issue-number prediction so new tickets
+        don't need a separate REST call for it.
+
+        Yields:
+            Issue dicts with the REST-style keys number, title, body, state, node_id
+        """
+        graphql_url = f"{self.base_url}/graphql"
+        owner, name = self.repository.split("/", 1)
+
+        query = """
+        query($owner: String!, $name: String!, $cursor: String, $firstPage: Boolean!) {
+          repository(owner: $owner, name: $name) {
+            latestIssue: issues(first: 1, orderBy: {field: CREATED_AT, direction: DESC}) @include(if: $firstPage) {
+              nodes {
+                number
+              }
+            }
+            latestPullRequest: pullRequests(first: 1, orderBy: {field: CREATED_AT, direction: DESC}) @include(if: $firstPage) {
+              nodes {
+                number
+              }
+            }
+            issues(first: 100, states: OPEN, labels: ["helpdesk"], after: $cursor) {
+              pageInfo {
+                endCursor
+                hasNextPage
+              }
+              nodes {
+                id
+                number
+                title
+                body
+                state
+              }
+            }
+          }
+        }
+        """
+
+        cursor = None
+        while True:
+            variables = {"owner": owner, "name": name, "cursor": cursor, "firstPage": cursor is None}
+
+            try:
+                response = self.session.post(
+                    graphql_url,
+                    json={"query": query, "variables": variables}
+                )
+                response.raise_for_status()
+                result = parse_json(response)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Error listing open helpdesk issues: {e}")
+                return
+
+            if "errors" in result:
+                logger.error(f"GraphQL errors: {result['errors']}")
+                return
+
+            repository = result["data"]["repository"]
+            if cursor is None:
+                self._seed_next_number(repository)
+
+            issues = repository["issues"]
+            for node in issues["nodes"]:
+                yield {
+                    "number": node["number"],
+                    "title": node["title"],
+                    "body": node["body"],
+                    "state": node["state"].lower(),
+                    "node_id": node["id"]
+                }
+
+            if not issues["pageInfo"]["hasNextPage"]:
+                return
+            cursor = issues["pageInfo"]["endCursor"]
+
+    def _seed_next_number(self, repository: Dict):
+        """
+        Set the next-issue-number prediction from a GraphQL repository result.
+
+        Issues and pull requests share one number sequence, so the highest
+        of the two latest numbers is used.
+
+        Args:
+            repository: Repository object with latestIssue and latestPullRequest
+        """
+        latest = [
+            node["number"]
+            for field in ("latestIssue", "latestPullRequest")
+            for node in (repository.get(field) or {}).get("nodes", [])
+        ]
+        if self._next_number is None:
+            self._next_number = max(latest, default=0) + 1
+
+    def load_thread_index(self) -> int:
+        """
+        Index all open helpdesk issues by the Message-IDs in their metadata.
+
+        Lists the issues once per run so that matching emails to threads
+        is a dict lookup instead of a search + metadata parse per email.
+
+        Returns:
+            Number of issues indexed
+        """
+        thread_index = {}
+        indexed_issues = {}
+
+        for issue in self.iter_open_helpdesk_issues():
+            metadata = parse_metadata_from_issue_body(issue.get('body') or '')
+            if not metadata:
+                continue
+
+            indexed_issues[issue['number']] = issue
+            for message_id in metadata.get('message_ids', []):
+                thread_index[message_id] = issue
+
+        indexed = len(indexed_issues)
+
+        with self._thread_index_lock:
+            self._thread_index = thread_index
+            self._indexed_issues = indexed_issues
+
+        logger.info(f"Indexed {len(thread_index)} message ID(s) from {indexed} open helpdesk issue(s)")
+        return indexed
+
+    def find_issue_by_message_ids(self, message_ids: Iterable[str]) -> Tuple[Optional[str], Optional[Dict]]:
+        """
+        Find the open helpdesk issue whose email thread contains a Message-ID.
+
+        Probes the thread index (loaded on first use) for each ID in order,
+        skipping empty and repeated IDs.
+
+        Args:
+            message_ids: Email Message-ID header values, in priority order
+
+        Returns:
+            Tuple of (matched Message-ID, issue data dict), or (None, None)
+        """
+        probe = [message_id for message_id in dict.fromkeys(message_ids) if message_id]
+        if not probe:
+            return None, None
+
+        # Held across the lazy load so concurrent workers build the index only once
+        with self._thread_index_lock:
+            if self._thread_index is None:
+                self.load_thread_index()
+
+            for message_id in probe:
+                issue = self._thread_index.get(message_id)
+                if issue:
+                    return message_id, issue
+
+        return None, None
+
+    def index_message_id(self, message_id: str, issue: Dict):
+        """
+        Record a Message-ID as belonging to an issue's thread.
+
+        Keeps the thread index current for later emails in the same run.
+        Each issue is indexed as a single dict: if the issue is already
+        indexed under another dict (e.g. a fresh copy from get_issue), that
+        copy's current fields are merged into the indexed one, so every
+        Message-ID of the issue sees the same, latest body.
+
+        Args:
+            message_id: Email Message-ID header value
+            issue: Issue data dict
+        """
+        with self._thread_index_lock:
+            if not message_id or self._thread_index is None:
+                return
+
+            indexed = self._indexed_issues.get(issue['number'])
+            if indexed is None:
+                self._indexed_issues[issue['number']] = issue
+            elif indexed is not issue:
+                indexed.update(issue)
+                issue = indexed
+
+            self._thread_index[message_id] = issue
+
     def add_labels(self, issue_number: int, labels: List[str]) -> bool:
         """
         Add labels to an issue.
@@ -205,7 +521,7 @@ class GitHubHelper:
         data = {"labels": labels}
 
         try:
-            response = requests.post(url, json=data, headers=self.headers)
+            response = self.session.post(url, json=data)
             response.raise_for_status()
             logger.info(f"Added labels to issue #{issue_number}: {labels}")
             return True
@@ -236,21 +552,26 @@ class GitHubHelper:
         Note: This is a best-effort prediction. The actual number
         may differ if issues are created concurrently.
 
+        The repository is only queried once per GitHubHelper, and not at
+        all when loading the thread index already seeded the prediction;
+        afterwards it is tracked locally from create_issue results.
+
         Returns:
             Predicted next issue number
         """
+        if self._next_number is not None:
+            return self._next_number
+
         url = f"{self.base_url}/repos/{self.repository}/issues"
         params = {"state": "all", "per_page": 1, "sort": "created", "direction": "desc"}
 
         try:
-            response = requests.get(url, params=params, headers=self.headers)
+            response = self.session.get(url, params=params)
             response.raise_for_status()
-            issues = response.json()
+            issues = parse_json(response)
 
-            if issues:
-                return issues[0]['number'] + 1
-            else:
-                return 1
+            self._next_number = issues[0]['number'] + 1 if issues else 1
+            return self._next_number
         except requests.exceptions.RequestException as e:
             logger.error(f"Error getting next issue number: {e}")
             return 1
@@ -290,13 +611,12 @@ class GitHubHelper:
 
         try:
             logger.info(f"Adding issue to project {project_id}")
-            response = requests.post(
+            response = self.session.post(
                 graphql_url,
-                json={"query": query, "variables": variables},
-                headers=self.headers
+                json={"query": query, "variables": variables}
             )
             response.raise_for_status()
-            result = response.json()
+            result = parse_json(response)
 
             if "errors" in result:
                 logger.error(f"GraphQL errors: {result['errors']}")
@@ -309,12 +629,170 @@ class GitHubHelper:
             logger.error(f"Error adding issue to project: {e}")
             return False
 
+    def _get_branch_head(self) -> Optional[Tuple[str, str]]:
+        """
+        Look up the default branch and its head commit via GraphQL.
+
+        Returns:
+            Tuple of (branch name, head commit OID), or None if failed
+        """
+        graphql_url = f"{self.base_url}/graphql"
+        owner, name = self.repository.split("/", 1)
+
+        query = """
+        query($owner: String!, $name: String!) {
+          repository(owner: $owner, name: $name) {
+            defaultBranchRef {
+              name
+              target {
+                oid
+              }
+            }
+          }
+        }
+        """
+
+        try:
+            response = self.session.post(
+                graphql_url,
+                json={"query": query, "variables": {"owner": owner, "name": name}}
+            )
+            response.raise_for_status()
+            result = parse_json(response)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error getting default branch head: {e}")
+            return None
+
+        if "errors" in result:
+            logger.error(f"GraphQL errors: {result['errors']}")
+            return None
+
+        ref = result["data"]["repository"]["defaultBranchRef"]
+        return ref["name"], ref["target"]["oid"]
+
+    def _cache_attachment(self, path: str, cache_key: Tuple[int, bytes], url: str):
+        """
+        Remember an uploaded attachment for reuse within this run.
+
+        Content previously stored at the same path was overwritten, so its
+        cached URL no longer serves those bytes and is forgotten.
+
+        Args:
+            path: Repository path the content was written to
+            cache_key: (issue number, SHA-256 of content)
+            url: URL of the uploaded file
+        """
+        previous_key = self._attachment_paths.get(path)
+        if previous_key is not None and previous_key != cache_key:
+            self._attachment_cache.pop(previous_key, None)
+        self._attachment_paths[path] = cache_key
+        self._attachment_cache[cache_key] = url
+
+    def upload_attachments(self, files: List[Tuple[str, bytes]], issue_number: int) -> List[Optional[str]]:
+        """
+        Upload several attachments to the repository in a single commit.
+
+        Uses the GraphQL createCommitOnBranch mutation, so an email with N
+        attachments costs one round-trip and one commit instead of N of each.
+        Files are stored in attachments/issue-{number}/{filename}, like
+        upload_attachment_to_repo, and already-uploaded content is reused.
+
+        Args:
+            files: List of (filename, file binary data) tuples
+            issue_number: Issue number (for organizing files)
+
+        Returns:
+            File URLs in the same order as files; all None if the commit failed
+        """
+        cache_keys = [(issue_number, hashlib.sha256(data).digest()) for _, data in files]
+        urls = [self._attachment_cache.get(key) for key in cache_keys]
+
+        # Callers give different content distinct names; repeats of one file share a path
+        additions = {}
+        for (filename, data), url in zip(files, urls):
+            if not url:
+                additions[f"attachments/issue-{issue_number}/{filename}"] = data
+
+        if not additions:
+            return urls
+
+        query = """
+        mutation($input: CreateCommitOnBranchInput!) {
+          createCommitOnBranch(input: $input) {
+            commit {
+              url
+            }
+          }
+        }
+        """
+
+        file_changes = {
+            "additions": [
+                {"path": path, "contents": base64.b64encode(data).decode('utf-8')}
+                for path, data in additions.items()
+            ]
+        }
+
+        with self._contents_write_lock:
+            # A stale head OID is rejected; refresh it once and retry
+            for attempt in range(2):
+                if self._branch_head is None or attempt:
+                    self._branch_head = self._get_branch_head()
+                    if self._branch_head is None:
+                        return urls
+
+                branch, head_oid = self._branch_head
+                variables = {
+                    "input": {
+                        "branch": {"repositoryNameWithOwner": self.repository, "branchName": branch},
+                        "message": {"headline": f"Add {len(additions)} attachment(s) for issue #{issue_number}"},
+                        "fileChanges": file_changes,
+                        "expectedHeadOid": head_oid
+                    }
+                }
+
+                try:
+                    logger.info(f"Committing {len(additions)} attachment(s) for issue #{issue_number}")
+                    response = self.session.post(
+                        f"{self.base_url}/graphql",
+                        json={"query": query, "variables": variables}
+                    )
+                    response.raise_for_status()
+                    result = parse_json(response)
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"Error committing attachments for issue #{issue_number}: {e}")
+                    return urls
+
+                if "errors" not in result:
+                    break
+                logger.warning(f"GraphQL errors: {result['errors']}")
+            else:
+                return urls
+
+            commit_url = result["data"]["createCommitOnBranch"]["commit"]["url"]
+            self._branch_head = (branch, commit_url.rsplit("/", 1)[1])
+
+        repo_url = commit_url.rsplit("/commit/", 1)[0]
+        for i, ((filename, _), key) in enumerate(zip(files, cache_keys)):
+            if not urls[i]:
+                path = f"attachments/issue-{issue_number}/{filename}"
+                urls[i] = f"{repo_url}/blob/{quote(branch)}/{quote(path)}"
+                self._cache_attachment(path, key, urls[i])
+
+        logger.info(f"Attachments committed for issue #{issue_number}: {commit_url}")
+        return urls
+
     def upload_attachment_to_repo(self, file_data: bytes, filename: str, issue_number: int) -> Optional[str]:
         """
         Upload an attachment to the repository using the Contents API.
 
         Files are stored in: attachments/issue-{number}/{filename}
 
+        Identical content is uploaded once per issue and run; repeats (such
+        as a signature logo in every reply) reuse the first URL. Attachments
+        are not shared across issues because cleanup removes each issue's
+        folder independently.
+
         Args:
             file_data: File binary data
             filename: Filename
@@ -323,7 +801,11 @@ class GitHubHelper:
         Returns:
             URL to the file in the repository, or None if failed
         """
-        import base64
+        cache_key = (issue_number, hashlib.sha256(file_data).digest())
+        cached_url = self._attachment_cache.get(cache_key)
+        if cached_url:
+            logger.info(f"Attachment {filename} already uploaded for issue #{issue_number}: {cached_url}")
+            return cached_url
 
         # Create path: attachments/issue-{number}/{filename}
         path = f"attachments/issue-{issue_number}/{filename}"
@@ -332,37 +814,36 @@ class GitHubHelper:
         # Encode file data as base64
         content_base64 = base64.b64encode(file_data).decode('utf-8')
 
-        # Check if file already exists (to get SHA for update)
-        try:
-            check_response = requests.get(url, headers=self.headers)
-            if check_response.status_code == 200:
-                existing_sha = check_response.json().get('sha')
-                logger.debug(f"File {filename} already exists, updating...")
-            else:
-                existing_sha = None
-        except:
-            existing_sha = None
-
         # Prepare request data
         data = {
             "message": f"Add attachment for issue #{issue_number}: {filename}",
             "content": content_base64
         }
 
-        if existing_sha:
-            data["sha"] = existing_sha
-
         try:
             logger.info(f"Uploading attachment to repo: {path} ({len(file_data)} bytes)")
-            response = requests.put(url, json=data, headers=self.headers)
+            # The existence check and the write must not interleave with another
+            # upload to the same path, or the PUT goes out without the new SHA
+            with self._contents_write_lock:
+                # Check if file already exists (to get SHA for update)
+                try:
+                    check_response = self.session.get(url)
+                    if check_response.status_code == 200:
+                        data["sha"] = parse_json(check_response).get('sha')
+                        logger.debug(f"File {filename} already exists, updating...")
+                except Exception:
+                    pass
+
+                response = self.session.put(url, json=data)
             response.raise_for_status()
-            result = response.json()
+            result = parse_json(response)
 
             # Get the URL to the file
             file_url = result.get('content', {}).get('html_url')
 
             if file_url:
                 logger.info(f"Attachment uploaded successfully: {file_url}")
+                self._cache_attachment(path, cache_key, file_url)
                 return file_url
             else:
                 logger.error(f"No URL in upload response")
@@ -7,15 +7,22 @@ Runs on issue_comment events via GitHub Actions.
 """
 
 import os
+import re
 import sys
 import json
 import logging
+from functools import lru_cache
 
-from email_helper import send_email
+try:
+    import orjson
+except ImportError:  # optional speedup; fall back to the stdlib parser
+    orjson = None
+
+from email_helper import SMTPSender, build_email
 from github_helper import GitHubHelper
 from utils import (
     parse_metadata_from_issue_body, has_email_marker,
-    generate_message_id, format_issue_title
+    generate_message_id, format_issue_title, format_metadata_comment
 )
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,7 +33,7 @@ def get_env_or_exit(var_name: str) -> str:
     """Get environment variable or exit if not set."""
     value = os.getenv(var_name)
     if not value:
-        logger.error(f"Environment variable {var_name} is not set")
+        logger.error("Environment variable %s is not set", var_name)
         sys.exit(1)
     return value
 
@@ -45,23 +52,24 @@ def should_skip_comment(event_data: dict, customer_bot_username: str = None) ->
     Returns:
         Tuple of (should_skip, reason)
     """
-    # Check if issue has helpdesk label
-    issue = event_data.get('issue', {})
-    labels = [label['name'] for label in issue.get('labels', [])]
+    # issue_comment payloads always carry these; a KeyError means a malformed event
+    try:
+        issue = event_data['issue']
+        comment = event_data['comment']
+        user_type = comment['user']['type']
+        comment_body = comment['body']
+    except (KeyError, TypeError):
+        return True, "Event is not a well-formed issue_comment payload"
 
-    if 'helpdesk' not in labels:
+    # Check if issue has helpdesk label
+    if not any(label.get('name') == 'helpdesk' for label in issue.get('labels') or ()):
         return True, "Issue does not have 'helpdesk' label"
 
     # Check if comment author is a bot
-    comment = event_data.get('comment', {})
-    user = comment.get('user', {})
-
-    if user.get('type') == 'Bot':
+    if user_type == 'Bot':
         return True, "Comment author is a bot"
 
     # Check if comment has email marker (originated from email)
-    comment_body = comment.get('body', '')
-
     if has_email_marker(comment_body):
         return True, "Comment originated from email (has marker)"
 
@@ -73,6 +81,20 @@ def should_skip_comment(event_data: dict, customer_bot_username: str = None) ->
     return False, ""
 
 
+@lru_cache(maxsize=None)
+def mention_pattern(customer_bot_username: str) -> re.Pattern:
+    """
+    Get the compiled case-insensitive pattern for an @username mention.
+
+    Args:
+        customer_bot_username: Bot username (without @)
+
+    Returns:
+        Compiled pattern matching "@username"
+    """
+    return re.compile(re.escape(f"@{customer_bot_username}"), re.IGNORECASE)
+
+
 def mentions_customer_bot(comment_body: str, customer_bot_username: str) -> bool:
     """
     Check if comment mentions the customer bot (indicating it should be sent to customer).
@@ -87,20 +109,18 @@ def mentions_customer_bot(comment_body: str, customer_bot_username: str) -> bool
     if not comment_body or not customer_bot_username:
         return False
 
-    # Check for @username mention (case insensitive)
-    mention = f"@{customer_bot_username}"
-
-    return mention.lower() in comment_body.lower()
+    # Check for @username mention (case insensitive) without lowercasing the body
+    return mention_pattern(customer_bot_username).search(comment_body) is not None
 
 
-def process_comment(event_data: dict, github: GitHubHelper, smtp_config: dict) -> bool:
+def process_comment(event_data: dict, github: GitHubHelper, sender: SMTPSender) -> bool:
     """
     Process a comment and send it via email.
 
     Args:
         event_data: GitHub webhook event data
         github: GitHubHelper instance
-        smtp_config: SMTP configuration dict
+        sender: SMTPSender session, connected on first send
 
     Returns:
         True if successful
@@ -112,25 +132,25 @@ def process_comment(event_data: dict, github: GitHubHelper, smtp_config: dict) -
     comment_body = comment['body']
     comment_author = comment['user']['login']
 
-    logger.info(f"[SEND] Processing comment on issue #{issue_number} by @{comment_author}")
+    logger.info("[SEND] Processing comment on issue #%s by @%s", issue_number, comment_author)
 
     # Parse metadata from issue body
     metadata = parse_metadata_from_issue_body(issue['body'])
 
     if not metadata:
-        logger.error(f"❌ Could not parse metadata from issue #{issue_number} - missing helpdesk metadata")
+        logger.error("❌ Could not parse metadata from issue #%s - missing helpdesk metadata", issue_number)
         return False
 
     customer_email = metadata.get('from')
     if not customer_email:
-        logger.error(f"❌ No customer email found in issue #{issue_number} metadata")
+        logger.error("❌ No customer email found in issue #%s metadata", issue_number)
         return False
 
-    logger.info(f"📧 Sending email to customer: {customer_email}")
+    logger.info("📧 Sending email to customer: %s", customer_email)
 
     message_ids = metadata.get('message_ids', [])
     if not message_ids:
-        logger.warning(f"⚠️  No message IDs found in issue #{issue_number} metadata - threading may not work")
+        logger.warning("⚠️  No message IDs found in issue #%s metadata - threading may not work", issue_number)
 
     # Generate new message ID
     new_message_id = generate_message_id()
@@ -140,16 +160,15 @@ def process_comment(event_data: dict, github: GitHubHelper, smtp_config: dict) -
     in_reply_to = message_ids[-1] if message_ids else ""
     references = message_ids
 
-    logger.info(f"Email subject: {subject}")
-    logger.info(f"Threading: In-Reply-To={in_reply_to[:30]}..." if in_reply_to else "Threading: First message in thread")
+    logger.info("Email subject: %s", subject)
+    if in_reply_to:
+        logger.info("Threading: In-Reply-To=%.30s...", in_reply_to)
+    else:
+        logger.info("Threading: First message in thread")
 
     # Send email
-    success = send_email(
-        smtp_host=smtp_config['host'],
-        smtp_port=smtp_config['port'],
-        smtp_user=smtp_config['user'],
-        smtp_password=smtp_config['password'],
-        from_addr=smtp_config['user'],
+    msg = build_email(
+        from_addr=sender.user,
         to_addr=customer_email,
         subject=subject,
         body=comment_body,
@@ -158,15 +177,15 @@ def process_comment(event_data: dict, github: GitHubHelper, smtp_config: dict) -
         message_id=new_message_id
     )
 
-    if success:
-        logger.info(f"✅ Email sent successfully to {customer_email}")
+    if sender.send(msg):
+        logger.info("✅ Email sent successfully to %s", customer_email)
 
         # Update issue metadata with new message ID
         update_issue_metadata(issue, new_message_id, metadata, github)
 
         return True
     else:
-        logger.error(f"❌ Failed to send email to {customer_email}")
+        logger.error("❌ Failed to send email to %s", customer_email)
         return False
 
 
@@ -181,60 +200,26 @@ def update_issue_metadata(issue: dict, new_message_id: str, metadata: dict, gith
         github: GitHubHelper instance
     """
     try:
-        from utils import format_metadata_comment
-
         # Add new message ID
-        old_message_ids = metadata['message_ids'].copy()
         metadata['message_ids'].append(new_message_id)
 
-        # Create old and new metadata comments
-        old_metadata_comment = format_metadata_comment(
-            metadata['thread_id'],
-            metadata['from'],
-            old_message_ids
-        )
+        # Create new metadata comment
         new_metadata_comment = format_metadata_comment(
             metadata['thread_id'],
             metadata['from'],
             metadata['message_ids']
         )
 
-        # Replace in issue body
-        new_body = issue['body'].replace(old_metadata_comment, new_metadata_comment)
+        # Replace in issue body at the position it was parsed from
+        start, end = metadata['span']
+        new_body = issue['body'][:start] + new_metadata_comment + issue['body'][end:]
 
         # Update issue
         github.update_issue(issue['number'], body=new_body)
-        logger.info(f"Updated metadata for issue #{issue['number']}")
+        logger.info("Updated metadata for issue #%s", issue['number'])
 
     except Exception as e:
-        logger.error(f"Error updating issue metadata: {e}")
-
-
-def get_authenticated_user(github_token: str) -> str:
-    """
-    Get the username of the authenticated GitHub user.
-
-    Args:
-        github_token: GitHub token
-
-    Returns:
-        Username of the authenticated user
-    """
-    import requests
-
-    try:
-        response = requests.get(
-            "https://api.github.com/user",
-            headers={
-                "Authorization": f"token {github_token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-        )
-        response.raise_for_status()
-        return response.json().get('login', '')
-    except Exception as e:
-        logger.warning(f"Could not get authenticated user: {e}")
-        return ''
+        logger.error("Error updating issue metadata: %s", e)
 
 
 def main():
@@ -250,61 +235,58 @@ def main():
     github_repository = get_env_or_exit('GITHUB_REPOSITORY')
     event_path = os.getenv('GITHUB_EVENT_PATH')
 
-    # Get the username of the authenticated user (customer bot)
-    customer_bot_username = get_authenticated_user(github_token)
-    if customer_bot_username:
-        logger.info(f"📋 Customer bot: @{customer_bot_username} - comments must mention this user to be sent to customer")
-    else:
-        logger.warning("⚠️  Could not determine customer bot username - all comments will be sent to customer")
-
     if not event_path:
         logger.error("GITHUB_EVENT_PATH not set (not running in GitHub Actions?)")
         sys.exit(1)
 
-    # Load event data
-    try:
-        with open(event_path, 'r') as f:
-            event_data = json.load(f)
-    except Exception as e:
-        logger.error(f"Failed to load event data: {e}")
-        sys.exit(1)
-
-    # Check if we should skip this comment
-    should_skip, reason = should_skip_comment(event_data, customer_bot_username)
-
-    if should_skip:
-        logger.info(f"⏭️  Skipping comment: {reason}")
-        sys.exit(0)
-
-    # Initialize GitHub helper
+    # Initialize GitHub helper; its session also serves the bot user lookup
     github = GitHubHelper(github_token, github_repository)
 
-    # SMTP configuration
-    smtp_config = {
-        'host': smtp_host,
-        'port': smtp_port,
-        'user': smtp_user,
-        'password': smtp_password
-    }
-
-    # Process comment
     try:
-        success = process_comment(event_data, github, smtp_config)
+        # Get the username of the customer bot; the token's user unless configured
+        customer_bot_username = os.getenv('CUSTOMER_BOT_USERNAME') or github.get_authenticated_user()
+        if customer_bot_username:
+            logger.info("📋 Customer bot: @%s - comments must mention this user to be sent to customer", customer_bot_username)
+        else:
+            logger.warning("⚠️  Could not determine customer bot username - all comments will be sent to customer")
+
+        # Load event data
+        try:
+            with open(event_path, 'rb') as f:
+                event_data = orjson.loads(f.read()) if orjson else json.load(f)
+        except Exception as e:
+            logger.error("Failed to load event data: %s", e)
+            sys.exit(1)
+
+        # Check if we should skip this comment
+        should_skip, reason = should_skip_comment(event_data, customer_bot_username)
 
-        if success:
-            logger.info("=" * 60)
-            logger.info("✅ Comment processed successfully - email sent to customer")
-            logger.info("=" * 60)
+        if should_skip:
+            logger.info("⏭️  Skipping comment: %s", reason)
             sys.exit(0)
-        else:
-            logger.error("=" * 60)
-            logger.error("❌ Failed to process comment - email not sent")
-            logger.error("=" * 60)
+
+        # Process comment; the SMTP session connects only if an email is sent
+        try:
+            with SMTPSender(smtp_host, smtp_port, smtp_user, smtp_password) as sender:
+                success = process_comment(event_data, github, sender)
+
+            if success:
+                logger.info("=" * 60)
+                logger.info("✅ Comment processed successfully - email sent to customer")
+                logger.info("=" * 60)
+                sys.exit(0)
+            else:
+                logger.error("=" * 60)
+                logger.error("❌ Failed to process comment - email not sent")
+                logger.error("=" * 60)
+                sys.exit(1)
+
+        except Exception as e:
+            logger.error("❌ Unexpected error processing comment: %s", e)
             sys.exit(1)
 
-    except Exception as e:
-        logger.error(f"❌ Unexpected error processing comment: {e}")
-        sys.exit(1)
+    finally:
+        github.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,56 @@
 """Shared utilities for parsing and formatting helpdesk data."""
 
+import json
 import os
 import re
+import secrets
+from functools import lru_cache
 from typing import Optional, Dict, List
 
+# Ticket prefix for issue titles; the environment is fixed for a workflow run
+TICKET_PREFIX = os.getenv('TICKET_PREFIX', 'GH')
+
+# Compiled once at import; these run for every email and every open issue
+METADATA_RE = re.compile(r'<!-- HELPDESK_METADATA\s+(.*?)\s+-->', re.DOTALL)
+EMAIL_ADDRESS_RE = re.compile(r'<([^>]+)>|([^\s<>]+@[^\s<>]+)')
+GH_TAG_RE = re.compile(r'\[GH-\d+\]\s*')
+REPLY_PREFIX_RE = re.compile(r'^(?:re:|fwd:|fw:)\s*', re.IGNORECASE)
+
+# Hidden marker identifying comments that originated from email
+EMAIL_MARKER = "<!-- source:email -->"
+
+# Escapes HTML-significant characters in one pass over the email body
+HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+
+@lru_cache(maxsize=None)
+def ticket_number_pattern(prefix: str) -> re.Pattern:
+    """
+    Get the compiled pattern matching "[PREFIX-1234]" for a ticket prefix.
+
+    Args:
+        prefix: Ticket prefix (e.g., "GH", "TICKET")
+
+    Returns:
+        Compiled pattern with the issue number as group 1
+    """
+    # Escape prefix for regex in case it contains special characters
+    return re.compile(rf'\[{re.escape(prefix)}-(\d+)\]')
+
+
+@lru_cache(maxsize=None)
+def ticket_tag_pattern(prefix: str) -> re.Pattern:
+    """
+    Get the compiled pattern matching a "[PREFIX-1234] " tag to strip from titles.
+
+    Args:
+        prefix: Ticket prefix (e.g., "GH", "TICKET")
+
+    Returns:
+        Compiled pattern including trailing whitespace
+    """
+    return re.compile(rf'\[{re.escape(prefix)}-\d+\]\s*')
+
 
 def parse_metadata_from_issue_body(body: str) -> Optional[Dict[str, any]]:
     """
@@ -13,38 +60,37 @@ def parse_metadata_from_issue_body(body: str) -> Optional[Dict[str, any]]:
         body: Issue body text containing hidden metadata
 
     Returns:
-        Dictionary with keys: thread_id, from, message_ids
+        Dictionary with keys: thread_id, from, message_ids, and span, the
+        (start, end) offsets of the metadata comment within body
         None if no metadata found
     """
-    pattern = r'<!-- HELPDESK_METADATA\s+(.*?)\s+-->'
-    match = re.search(pattern, body, re.DOTALL)
+    match = METADATA_RE.search(body)
 
     if not match:
         return None
 
-    metadata_text = match.group(1)
     metadata = {}
 
-    # Parse thread_id
-    thread_id_match = re.search(r'thread_id:\s*(.+)', metadata_text)
-    if thread_id_match:
-        metadata['thread_id'] = thread_id_match.group(1).strip()
-
-    # Parse from
-    from_match = re.search(r'from:\s*(.+)', metadata_text)
-    if from_match:
-        metadata['from'] = from_match.group(1).strip()
-
-    # Parse message_ids (JSON array format)
-    message_ids_match = re.search(r'message_ids:\s*(\[.*?\])', metadata_text, re.DOTALL)
-    if message_ids_match:
-        import json
-        try:
-            metadata['message_ids'] = json.loads(message_ids_match.group(1))
-        except json.JSONDecodeError:
-            metadata['message_ids'] = []
-    else:
-        metadata['message_ids'] = []
+    # One "key: value" pair per line; the first occurrence of a key wins
+    for line in match.group(1).splitlines():
+        key, sep, value = line.partition(':')
+        key = key.strip()
+        if not sep or key in metadata:
+            continue
+
+        value = value.strip()
+        if key in ('thread_id', 'from'):
+            metadata[key] = value
+        elif key == 'message_ids':
+            # JSON array format
+            try:
+                metadata['message_ids'] = json.loads(value)
+            except json.JSONDecodeError:
+                metadata['message_ids'] = []
+
+    metadata.setdefault('message_ids', [])
+    # Lets callers rewrite the block in place without searching for it again
+    metadata['span'] = match.span()
 
     return metadata
 
@@ -61,8 +107,12 @@ def format_metadata_comment(thread_id: str, from_email: str, message_ids: List[s
     Returns:
         HTML comment string with metadata
     """
-    import json
-    message_ids_json = json.dumps(message_ids)
+    # Message-IDs are plain printable ASCII in practice, so they can be quoted
+    # directly; anything needing JSON escapes goes through json.dumps
+    if all(m.isascii() and m.isprintable() and '"' not in m and '\\' not in m for m in message_ids):
+        message_ids_json = '[' + ', '.join(f'"{m}"' for m in message_ids) + ']'
+    else:
+        message_ids_json = json.dumps(message_ids)
 
     return f"""<!-- HELPDESK_METADATA
 thread_id: {thread_id}
@@ -83,11 +133,13 @@ def extract_gh_number_from_subject(subject: str, prefix: str = None) -> Optional
         Issue number as integer, or None if not found
     """
     if prefix is None:
-        prefix = os.getenv('TICKET_PREFIX', 'GH')
+        prefix = TICKET_PREFIX
 
-    # Escape prefix for regex in case it contains special characters
-    escaped_prefix = re.escape(prefix)
-    match = re.search(rf'\[{escaped_prefix}-(\d+)\]', subject)
+    # Most new emails carry no tag; a substring probe settles those cheaply
+    if f"[{prefix}-" not in subject:
+        return None
+
+    match = ticket_number_pattern(prefix).search(subject)
     if match:
         return int(match.group(1))
     return None
@@ -106,15 +158,17 @@ def format_issue_title(issue_number: int, subject: str, prefix: str = None) -> s
         Formatted title like "[GH-0042] Subject" or "[TICKET-0042] Subject"
     """
     if prefix is None:
-        prefix = os.getenv('TICKET_PREFIX', 'GH')
+        prefix = TICKET_PREFIX
 
     # Remove any existing [PREFIX-####] prefix
-    escaped_prefix = re.escape(prefix)
-    clean_subject = re.sub(rf'\[{escaped_prefix}-\d+\]\s*', '', subject)
-    # Also remove old GH prefix if switching prefixes
-    clean_subject = re.sub(r'\[GH-\d+\]\s*', '', clean_subject)
+    clean_subject = subject
+    # Subjects without a bracket can't hold a tag; most new tickets skip both subs
+    if '[' in clean_subject:
+        clean_subject = ticket_tag_pattern(prefix).sub('', clean_subject)
+        # Also remove old GH prefix if switching prefixes
+        clean_subject = GH_TAG_RE.sub('', clean_subject)
     # Remove Re:, Fwd:, etc.
-    clean_subject = re.sub(r'^(Re:|RE:|Fwd:|FW:)\s*', '', clean_subject, flags=re.IGNORECASE)
+    clean_subject = REPLY_PREFIX_RE.sub('', clean_subject)
 
     return f"[{prefix}-{issue_number:04d}] {clean_subject.strip()}"
 
@@ -129,13 +183,19 @@ def sanitize_email_body(body: str) -> str:
     Returns:
         Sanitized text safe for GitHub Markdown
     """
-    # Basic sanitization - escape HTML tags if present
-    body = body.replace('<', '&lt;').replace('>', '&gt;')
-
     # Limit length to prevent extremely long issues
     max_length = 50000
+    truncated = len(body) > max_length
+
+    # Basic sanitization - escape HTML tags and entities if present. Escaping
+    # only lengthens text, so only the first max_length characters can survive
+    body = body[:max_length].translate(HTML_ESCAPE_TABLE)
     if len(body) > max_length:
-        body = body[:max_length] + '\n\n[Content truncated...]'
+        body = body[:max_length]
+        truncated = True
+
+    if truncated:
+        body += '\n\n[Content truncated...]'
 
     return body
 
@@ -150,15 +210,8 @@ def generate_message_id(domain: str = "github-helpdesk") -> str:
     Returns:
         Message-ID string like "<unique-id@domain>"
     """
-    import time
-    import random
-    import hashlib
-
-    # Create unique identifier using timestamp + random data
-    unique_str = f"{time.time()}-{random.randint(0, 999999)}"
-    hash_id = hashlib.sha256(unique_str.encode()).hexdigest()[:16]
-
-    return f"<{hash_id}@{domain}>"
+    # 64 random bits from the OS CSPRNG, hex-encoded
+    return f"<{secrets.token_hex(8)}@{domain}>"
 
 
 def parse_email_address(addr_string: str) -> str:
@@ -172,7 +225,7 @@ def parse_email_address(addr_string: str) -> str:
         Clean email address
     """
     # Match email in angle brackets or standalone
-    match = re.search(r'<([^>]+)>|([^\s<>]+@[^\s<>]+)', addr_string)
+    match = EMAIL_ADDRESS_RE.search(addr_string)
     if match:
         return match.group(1) or match.group(2)
     return addr_string.strip()
@@ -185,7 +238,7 @@ def create_email_marker() -> str:
     Returns:
         HTML comment string
     """
-    return "<!-- source:email -->"
+    return EMAIL_MARKER
 
 
 def has_email_marker(text: str) -> bool:
@@ -193,9 +246,9 @@ def has_email_marker(text: str) -> bool:
     Check if text contains email source marker.
 
     Args:
-        text: Text to check
+        text: Text to check (may be None or empty)
 
     Returns:
         True if marker is present
     """
-    return "<!-- source:email -->" in text
+    return bool(text) and EMAIL_MARKER in text